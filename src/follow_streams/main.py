@@ -1,19 +1,24 @@
 from __future__ import annotations
 
-import multiprocessing as mp
-import queue
+import re
 from argparse import ArgumentParser, Namespace
-from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from hashlib import sha256
 from pathlib import Path
 from time import monotonic as now
 from typing import Any
 
+import numpy as np
 import osmium
 import osmium.filter
+import osmium.geom
 import osmium.osm
-from geopandas import GeoDataFrame
+import shapely
+from geopandas import GeoDataFrame, GeoSeries
 from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
 from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path as MplPath
 
 start = now()
 
@@ -51,6 +56,28 @@ class DropIdFilter:
         return v.id == self._ident
 
 
+WATER_TAGS = (
+    ("natural", "water"),
+    ("natural", "strait"),
+    ("natural", "bay"),
+    ("water", "lake"),
+    # ("water", "oxbow"),
+    ("water", "river"),
+    ("water", "stream"),
+    # ("water", "pond"),
+    ("water", "reservoir"),
+    ("waterway", "stream"),
+    ("waterway", "river"),
+    ("waterway", "tidal_channel"),
+    ("waterway", "canal"),
+    # ("waterway", "ditch"),
+    # ("waterway", "drain"),
+)
+DROPPED_WAY_ID = 631469130  # Stream goes uphill here! 47.02694289590613, -122.93298280193007
+# Part of every cache file name, so changing what read() keeps invalidates the caches
+READ_CONFIG_HASH = sha256(repr((WATER_TAGS, DROPPED_WAY_ID)).encode()).hexdigest()[:8]
+
+
 def read(source: Path) -> GeoDataFrame:
     log("start read")
     fp = (
@@ -58,84 +85,114 @@ def read(source: Path) -> GeoDataFrame:
         .with_locations()
         .with_areas()
         .with_filter(osmium.filter.EntityFilter(osmium.osm.AREA | osmium.osm.WAY))
-        .with_filter(
-            osmium.filter.TagFilter(
-                ("natural", "water"),
-                ("natural", "strait"),
-                ("natural", "bay"),
-                ("water", "lake"),
-                # ("water", "oxbow"),
-                ("water", "river"),
-                ("water", "stream"),
-                # ("water", "pond"),
-                ("water", "reservoir"),
-                ("waterway", "stream"),
-                ("waterway", "river"),
-                ("waterway", "tidal_channel"),
-                ("waterway", "canal"),
-                # ("waterway", "ditch"),
-                # ("waterway", "drain"),
-            )
-        )
+        .with_filter(osmium.filter.TagFilter(*WATER_TAGS))
         .with_filter(DropIntermittentFilter())
-        .with_filter(DropIdFilter(631469130))  # Stream goes uphill here! 47.02694289590613, -122.93298280193007
-        .with_filter(osmium.filter.GeoInterfaceFilter(tags=["name"]))
+        .with_filter(DropIdFilter(DROPPED_WAY_ID))
     )
-    return GeoDataFrame.from_features(fp, crs="EPSG:4326")
-
-
-# depends on fork!
-g_frontier = mp.Queue()
-g_gdf: None | GeoDataFrame = None
+    # Collect WKB and names into flat lists, then build the geometries in one vectorized call
+    factory = osmium.geom.WKBFactory()
+    wkbs = []
+    names = []
+    n_degenerate = 0
+    for obj in fp:
+        try:
+            if isinstance(obj, osmium.osm.Area):
+                wkb = factory.create_multipolygon(obj)
+            elif isinstance(obj, osmium.osm.Way):
+                wkb = factory.create_linestring(obj)
+            else:
+                continue
+        except osmium.InvalidLocationError:
+            raise  # missing node locations mean a broken extract, don't silently drop streams
+        except RuntimeError:
+            n_degenerate += 1  # e.g. a way with fewer than two distinct points
+            continue
+        wkbs.append(wkb)
+        names.append(obj.tags.get("name"))
+    if n_degenerate > 0:
+        log(f"skipped {n_degenerate} degenerate geometries")
+    return GeoDataFrame({"name": names}, geometry=GeoSeries.from_wkb(wkbs, crs="EPSG:4326"))
+
+
+def cache_path(cache_dir: Path, source: Path, kind: str) -> Path:
+    # Geofabrik extracts keep the same name across refreshes, so key on size and mtime too
+    st = source.stat()
+    return cache_dir / f"{source.stem}-{st.st_size}-{st.st_mtime_ns}-{READ_CONFIG_HASH}.{kind}.fgb"
+
+
+def write_cache(gdf: GeoDataFrame, cache_dir: Path, source: Path, kind: str) -> None:
+    cache_dir.mkdir(exist_ok=True)
+    # Remove caches left by older downloads of this extract or an older read configuration
+    pattern = re.compile(rf"{re.escape(source.stem)}-\d+-\d+-[0-9a-f]+\.{kind}\.fgb")
+    for stale in cache_dir.iterdir():
+        if pattern.fullmatch(stale.name):
+            stale.unlink()
+    gdf.to_file(cache_path(cache_dir, source, kind), driver="FlatGeobuf", engine="pyogrio")
+
+
+def read_cached(source: Path, cache_dir: Path) -> GeoDataFrame:
+    cache = cache_path(cache_dir, source, "read")
+    if cache.exists():
+        log("load read cache")
+        return GeoDataFrame.from_file(cache, engine="pyogrio")
+    gdf = read(source)
+    write_cache(gdf, cache_dir, source, "read")
+    return gdf
 
 
-def find_neighbors(start_idx: Any) -> None:
-    global g_frontier
-    global g_gdf
-    assert g_gdf is not None
-    start_geo = g_gdf.loc[start_idx]["geometry"]
-    is_touching = g_gdf["geometry"].intersects(start_geo)
-    for idx in g_gdf[is_touching].index:
-        g_frontier.put_nowait(idx)
+def neighbor_index(gdf: GeoDataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """Find all intersecting pairs of geometries with one spatial index query.
+
+    Returns the adjacency in CSR form: the positional neighbors of row i are
+    neighbors[offsets[i]:offsets[i + 1]].
+    """
+    geoms = gdf.geometry.values
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate="intersects")
+    order = np.argsort(left, kind="stable")
+    neighbors = right[order]
+    offsets = np.zeros(len(geoms) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(left, minlength=len(geoms)), out=offsets[1:])
+    return neighbors, offsets
+
+
+def reachable_from(neighbors: np.ndarray, offsets: np.ndarray, start: int) -> np.ndarray:
+    """Breadth-first search over a CSR adjacency, one whole level at a time.
+
+    Returns a boolean mask of the rows reachable from start.
+    """
+    reached = np.zeros(len(offsets) - 1, dtype=bool)
+    reached[start] = True
+    frontier = np.array([start], dtype=np.intp)
+    level = 0
+    while frontier.size > 0:
+        if level % 100 == 0:
+            log(f"{level=}, frontier={frontier.size}, reached={reached.sum()}")
+        level += 1
+
+        # Gather the CSR slices of every frontier node in one go
+        starts = offsets[frontier]
+        counts = offsets[frontier + 1] - starts
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        candidates = np.unique(neighbors[positions])
+        frontier = candidates[~reached[candidates]]
+        reached[frontier] = True
+    return reached
 
 
 def reachability_filter(gdf: GeoDataFrame) -> GeoDataFrame:
-    global g_gdf
-
     # Quick filter based on rectangle that puget sound watershed is in
-    centroids = gdf["geometry"].centroid
-    close_enough = (centroids.x < -120.6) & (centroids.y > 46.5)
-    gdf = gdf[close_enough]
-    print(gdf)
+    gdf = gdf.cx[-180:-120.6, 46.5:90]
+    log(f"{len(gdf)} features in bounding box")
 
     # Expensive filter by graph reachability
-    puget_sound_idx = gdf[gdf["name"] == "Puget Sound"].index[0]
-    g_frontier.put_nowait(puget_sound_idx)
-    reached = set()
-    iters = 0
-    in_prog_futures = set()
-    g_gdf = gdf
-    assert mp.get_start_method() == "fork"
-    with ProcessPoolExecutor() as pool:
-        while g_frontier.qsize() > 0 or len(in_prog_futures) > 0:
-            if iters % 1000 == 0:
-                log(f"{iters=}, frontier={g_frontier.qsize()}, reached={len(reached)}")
-            iters += 1
-
-            try:
-                node = g_frontier.get(timeout=0.1)
-            except queue.Empty:
-                # if there's no work to do for this process. Wait for a result from another process.
-                done_futures, in_prog_futures = wait(in_prog_futures, return_when=FIRST_COMPLETED)
-                for f in done_futures:
-                    f.result()  # raise exceptions
-                continue
-            if node in reached:
-                continue
-            reached.add(node)
-            in_prog_futures.add(pool.submit(find_neighbors, node))
-    gdf = gdf.loc[list(reached)]
-    print(gdf)
+    log("start neighbor index")
+    neighbors, offsets = neighbor_index(gdf)
+    log(f"found {len(neighbors)} intersecting pairs")
+    puget_sound_pos = np.flatnonzero((gdf["name"] == "Puget Sound").to_numpy())[0]
+    reached = reachable_from(neighbors, offsets, puget_sound_pos)
+    gdf = gdf[reached]
+    log(f"{len(gdf)} features reachable from Puget Sound")
 
     return gdf
 
@@ -148,7 +205,30 @@ def render(gdf: GeoDataFrame, dest: Path) -> None:
     height_inch = 1.2 * width_inch
     fig = Figure(figsize=(width_inch, height_inch), dpi=dpi, layout="constrained")
     ax = fig.add_subplot()
-    gdf.plot(ax=ax, linewidth=1)
+    # Merge all polygons into one compound PathPatch built from the ragged coordinate arrays, rather than
+    # one patch per polygon as GeoDataFrame.plot does. Lines still get one Path each in the LineCollection.
+    parts = shapely.get_parts(gdf.geometry.values)
+    type_ids = shapely.get_type_id(parts)
+    is_polygon = type_ids == shapely.GeometryType.POLYGON
+    is_line = type_ids == shapely.GeometryType.LINESTRING
+    unhandled = {shapely.GeometryType(t).name for t in type_ids[~(is_polygon | is_line)]}
+    if unhandled:
+        raise ValueError(f"Cannot render geometry types: {sorted(unhandled)}")
+    polygons = parts[is_polygon]
+    lines = parts[is_line]
+    if len(polygons) > 0:
+        _, coords, (ring_offsets, _) = shapely.to_ragged_array(polygons)
+        codes = np.full(len(coords), MplPath.LINETO, dtype=MplPath.code_type)
+        codes[ring_offsets[:-1]] = MplPath.MOVETO
+        codes[ring_offsets[1:] - 1] = MplPath.CLOSEPOLY
+        ax.add_patch(PathPatch(MplPath(coords, codes), color="C0", linewidth=1))
+    if len(lines) > 0:
+        _, coords, (line_offsets,) = shapely.to_ragged_array(lines)
+        ax.add_collection(LineCollection(np.split(coords, line_offsets[1:-1]), colors="C0", linewidths=1))
+    ax.autoscale_view()
+    # Same aspect correction GeoDataFrame.plot applies for geographic coordinates
+    _, miny, _, maxy = shapely.total_bounds(parts)
+    ax.set_aspect(1 / np.cos(np.deg2rad((miny + maxy) / 2)))
     ax.set_axis_off()
     assert not dest.is_dir()
     FigureCanvasAgg(fig).print_png(dest)
@@ -158,12 +238,13 @@ def main() -> None:
     args = handle_args()
     here = Path(__file__).resolve().parent
     cache_dir = here / ".gdf_cache"
-    if cache_dir.exists():
-        gdf = GeoDataFrame.from_file(cache_dir)
+    cache = cache_path(cache_dir, args.source, "reachable")
+    if cache.exists():
+        gdf = GeoDataFrame.from_file(cache, engine="pyogrio")
     else:
-        gdf = read(args.source)
+        gdf = read_cached(args.source, cache_dir)
         gdf = reachability_filter(gdf)
-        gdf.to_file(cache_dir)
+        write_cache(gdf, cache_dir, args.source, "reachable")
     render(gdf, args.dest)
     log("done")
 